@@ -1,4 +1,5 @@
 from conf import TELEGRAM_TOKEN
+from profiler import profiler
 
 import telebot
 from telebot.types import BotCommand
@@ -15,6 +16,10 @@ class MyBot(telebot.TeleBot):
         bot.send_chat_action(chat_id, "typing")
         return super().send_message(chat_id, text, **kwargs)
 
+    def _exec_task(self, task, *args, **kwargs):
+        # Cada update pasa por aqui; el profiler lo usa para medir su duracion
+        return super()._exec_task(profiler.track(task), *args, **kwargs)
+
 
 bot = MyBot(TELEGRAM_TOKEN)
 
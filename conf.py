@@ -9,11 +9,23 @@ load_dotenv()
 tasa_mlc = 260
 tasa_usd = 370
 
+monedas = ("CUP", "USD", "MLC")
+
 commands = ("/start", "/balance", "/ingresar", "/extraer", "/historial", "/convertir", "/help", "/grafica")
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Ids de Telegram separados por comas con acceso a comandos de administracion
+ADMIN_IDS = {int(i) for i in os.getenv("ADMIN_IDS", "").split(",") if i.strip()}
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "perfiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))
+PROFILE_SECONDS = float(os.getenv("PROFILE_SECONDS", "30"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "300"))
+# El modo con umbral busca casos raros, por eso admite sesiones mucho mas largas
+PROFILE_MAX_SLOW_SECONDS = float(os.getenv("PROFILE_MAX_SLOW_SECONDS", "86400"))
+
 
 configure_logging()
 logger = logging.getLogger("app")
\ No newline at end of file
@@ -1,4 +1,5 @@
 import logging
+from datetime import datetime
 from typing import Dict, Optional
 
 import conf
@@ -15,12 +16,15 @@ from sqlalchemy import (
     Table,
     Text,
     Float,
+    Index,
     Numeric,
     Interval,
     DateTime,
     create_engine,
     delete,
     insert,
+    inspect,
+    select,
     update,
 )
 from sqlalchemy.orm import scoped_session, sessionmaker
@@ -39,8 +43,21 @@ class DatabaseManager:
 
         self.tramites = Table("tramites", self.metadata, *self._get_tramites_columns())
         self.users = Table("users", self.metadata, *self._get_user_columns())
-
-        self.metadata.create_all(self.engine)
+        self.wallets = Table("wallets", self.metadata, *self._get_wallets_columns())
+
+        # Historial, grafica y exportar filtran por usuario y moneda ordenando por fecha
+        Index("ix_tramites_user_type_date", self.tramites.c.user_id, self.tramites.c.type, self.tramites.c.date)
+
+        # Crear wallets y rellenarla en la misma transaccion: si el backfill falla
+        # la tabla tampoco queda creada y se reintenta en el siguiente arranque
+        with self.engine.begin() as conn:
+            wallets_nuevo = not inspect(conn).has_table("wallets")
+            self.metadata.create_all(conn)
+            # create_all no agrega indices a tablas ya existentes
+            for index in self.tramites.indexes:
+                index.create(conn, checkfirst=True)
+            if wallets_nuevo:
+                self._backfill_wallets(conn)
 
     def _get_user_columns(self):
         return [
@@ -65,6 +82,28 @@ class DatabaseManager:
             Column("date", TIMESTAMP(), default=func.now()),
         ]
 
+    def _get_wallets_columns(self):
+        return [
+            Column("user_id", ForeignKey("users.id", ondelete="CASCADE"), primary_key=True),
+            Column("currency", String(3), primary_key=True),
+            Column("balance", Float, nullable=False, default=0.0),
+            Column("updated_at", TIMESTAMP(), default=func.now(), onupdate=func.now()),
+        ]
+
+    def _backfill_wallets(self, conn):
+        """Crea las billeteras a partir del ultimo tramite de cada usuario y moneda."""
+        t = self.tramites
+        ultimos = (
+            select(t.c.user_id, t.c.type, t.c.current_balance)
+            .distinct(t.c.user_id, t.c.type)
+            .order_by(t.c.user_id, t.c.type, t.c.id.desc())
+        )
+        query = pg_insert(self.wallets).from_select(
+            ["user_id", "currency", "balance"], ultimos
+        ).on_conflict_do_nothing()
+        conn.execute(query)
+        logger.info("Wallets backfilled from tramites")
+
     def connect(self):
         self.session = self.Session()
         logger.info("Connected to database")
@@ -130,23 +169,79 @@ class DatabaseManager:
 
 
     #aditional methods
-    def get_last_id(self, user_id):
-        query = self.tramites.select().where(self.tramites.c.user_id == user_id).order_by(self.tramites.c.id.desc()).limit(1)
-        result = self.session.execute(query).fetchone()
-        return result.id if result else None
-
-    def get_current_balance(self, last_id):
-        if last_id is None:
-            return 0.0
-        query = self.tramites.select().where(self.tramites.c.id == last_id)
-        result = self.session.execute(query).fetchone()
-        return result.current_balance if result else 0.0
-
-    def get_coin_type(self, last_id, field="type"):
-        if last_id is None:
-            return "CUP"
-        query = self.tramites.select().where(self.tramites.c.id == last_id)
-        result = self.session.execute(query).fetchone()
-        return getattr(result, field) if result else "CUP"
+    # Las lecturas y los movimientos usan su propia conexion: self.session es compartida
+    # entre los hilos de telebot y un rollback/commit en ella afectaria a otras peticiones
+    def get_wallet_balance(self, user_id, currency):
+        query = select(self.wallets.c.balance).where(
+            self.wallets.c.user_id == user_id, self.wallets.c.currency == currency
+        )
+        with self.engine.connect() as conn:
+            result = conn.execute(query).scalar()
+        return result if result is not None else 0.0
+
+    def get_wallets(self, user_id):
+        query = self.wallets.select().where(self.wallets.c.user_id == user_id).order_by(self.wallets.c.currency)
+        with self.engine.connect() as conn:
+            return conn.execute(query).fetchall()
+
+    def get_tramites(self, user_id, currency=None, descending=False):
+        query = self.tramites.select().where(self.tramites.c.user_id == user_id)
+        if currency is not None:
+            query = query.where(self.tramites.c.type == currency)
+        order = self.tramites.c.date.desc() if descending else self.tramites.c.date.asc()
+        with self.engine.connect() as conn:
+            return conn.execute(query.order_by(order)).fetchall()
+
+    def _move(self, conn, user_id, currency, operation, deposited=0.0, extracted=0.0):
+        """
+        Aplica un movimiento sobre la billetera (user_id, currency) y registra el tramite
+        dentro de la transaccion de conn. Devuelve (saldo_anterior, saldo_actual) o None si el saldo no alcanza.
+        """
+        w = self.wallets
+        wallet = (w.c.user_id == user_id) & (w.c.currency == currency)
+        if deposited > extracted:
+            conn.execute(
+                pg_insert(w).values(user_id=user_id, currency=currency, balance=0.0).on_conflict_do_nothing()
+            )
+
+        # Bloquear la fila hasta el commit: el saldo anterior del tramite es el leido aqui
+        previous_balance = conn.execute(select(w.c.balance).where(wallet).with_for_update()).scalar()
+        if previous_balance is None or extracted > previous_balance + deposited:
+            return None
+        current_balance = previous_balance + deposited - extracted
+
+        conn.execute(update(w).where(wallet).values(balance=current_balance))
+
+        conn.execute(insert(self.tramites).values(
+            user_id=user_id,
+            operation=operation,
+            current_balance=current_balance,
+            money_deposited=deposited,
+            money_extracted=extracted,
+            previous_balance=previous_balance,
+            type=currency,
+            date=datetime.now(),
+        ))
+        return previous_balance, current_balance
+
+    def _save_user(self, conn, user: Dict):
+        conn.execute(pg_insert(self.users).values(user).on_conflict_do_nothing(index_elements=['id']))
+
+    def apply_movement(self, user: Dict, currency, operation, deposited=0.0, extracted=0.0):
+        """Guarda el usuario y aplica el movimiento en una sola transaccion."""
+        with self.engine.begin() as conn:
+            self._save_user(conn, user)
+            return self._move(conn, user["id"], currency, operation, deposited, extracted)
+
+    def convert(self, user: Dict, currency, amount, rate, target="CUP"):
+        """Mueve amount de la billetera currency a target en una sola transaccion."""
+        user_id = user["id"]
+        with self.engine.begin() as conn:
+            self._save_user(conn, user)
+            origen = self._move(conn, user_id, currency, "extraccion", extracted=amount)
+            if origen is None:
+                return None
+            destino = self._move(conn, user_id, target, "ingreso", deposited=amount * rate)
+            return origen, destino
 
 db = DatabaseManager(conf.DATABASE_URL)
@@ -2,179 +2,172 @@
 Bot de Telegram para gestión de monedero personal.
 Permite ingresar, extraer, consultar saldo y ver historial de transacciones.
 """
-import traceback, csv, io, matplotlib, matplotlib.pyplot as plt
+import traceback, csv, io, math, signal, matplotlib, matplotlib.pyplot as plt
 matplotlib.use('Agg')
-from datetime import datetime
 from telebot.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 
 from bot import bot
 
 from database import db
 
-from conf import tasa_mlc, tasa_usd, commands, logger
+from profiler import profiler
 
-moneda = None
-valor = None
+from conf import tasa_mlc, tasa_usd, monedas, commands, logger, ADMIN_IDS, PROFILE_SECONDS, PROFILE_MAX_SECONDS, PROFILE_MAX_SLOW_SECONDS
 
 db.connect()
 
 #funciones
-def guardar_usuario(msg):
-    """Guarda o actualiza la información del usuario en la base de datos."""
-    dataUser = {
+def datos_usuario(msg):
+    """Datos del usuario que se guardan junto con cada movimiento."""
+    return {
         "id": msg.from_user.id,
         "username": msg.from_user.username,
         "first_name": msg.from_user.first_name,
         "last_name": msg.from_user.last_name
     }
-    db.create_model(dataUser, db.users)
-
-def guardar_transaccion(msg, operation, current_balance, deposited, extracted, previous_balance, tipo):
-    """Guarda una transacción en la base de datos."""
-    dataIngreso = {
-        "user_id": msg.from_user.id,
-        "operation": operation,
-        "current_balance": current_balance,
-        "money_deposited": deposited,
-        "money_extracted": extracted,
-        "previous_balance": previous_balance,
-        "type": tipo,
-        "date": datetime.now()
-    }
-    db.create_model(dataIngreso, db.tramites)
 
-def pedir_moneda(msg):
+def leer_monto(msg):
     """
-    Solicita al usuario el tipo de moneda después de ingresar un monto.
-    
-    Args:
-        msg: Mensaje de Telegram con el monto ingresado por el usuario.
+    Extrae un monto positivo del mensaje. Devuelve None y avisa al usuario si no es valido.
+    El punto es el separador decimal y las comas se ignoran (1,000.50 = 1000.5).
     """
     #Limpiando el emoji y espacios
     texto = msg.text.strip()
     monto_limpio = ''.join(c for c in texto if c.isdigit() or c == '.')
-    
+
     try:
-        monto = float(monto_limpio.replace(",", "."))
+        # Los montos negativos no se aceptan aunque el signo se descarte al limpiar
+        if '-' in texto:
+            raise ValueError
+        monto = float(monto_limpio)
         if monto <= 0:
             raise ValueError
     except ValueError:
         bot.send_message(msg.chat.id, "⚠️ Por favor, ingresa un monto valido y positivo.")
-        return
+        return None
+    return monto
+
+def leer_moneda(msg, validas=monedas):
+    """Extrae el tipo de moneda del mensaje. Devuelve None y avisa al usuario si no es valida."""
+    # Extraer solo letras mayúsculas (eliminando emojis y espacios)
+    moneda = ''.join(c for c in msg.text.strip() if c.isalpha()).upper()
+
+    if moneda not in validas:
+        bot.send_message(msg.chat.id, "❌ Moneda invalida!", reply_markup=ReplyKeyboardRemove())
+        return None
+    return moneda
+
+def leer_filtro_moneda(msg):
+    """
+    Lee el filtro de billetera opcional de un comando, p. ej. /historial USD.
+    Devuelve None si no se indica y lanza ValueError si la moneda no es valida.
+    """
+    args = msg.text.split()[1:]
+    if not args:
+        return None
+    moneda = args[0].upper()
+    if moneda not in monedas:
+        raise ValueError(moneda)
+    return moneda
+
+def pedir_moneda(msg, siguiente):
+    """
+    Solicita al usuario la billetera sobre la que operar después de ingresar un monto.
     
-    global valor
-    valor = monto
+    Args:
+        msg: Mensaje de Telegram con el monto ingresado por el usuario.
+        siguiente: Paso que procesa la operación (procesar_ingreso o procesar_extraccion).
+    """
+    monto = leer_monto(msg)
+    if monto is None:
+        return
     
     markup = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
-    markup.add(KeyboardButton("💲CUP"), KeyboardButton("💲USD"), KeyboardButton("💲MLC"))
+    markup.add(*(KeyboardButton(f"💲{m}") for m in monedas))
     
     bot.send_message(msg.chat.id, "Especifique el tipo de moneda (CUP, USD, MLC):", reply_markup=markup)
-    bot.register_next_step_handler(msg, procesar_ingreso, monto)
+    bot.register_next_step_handler(msg, siguiente, monto)
     
 def procesar_ingreso(msg, monto):
     """
     Procesa el ingreso de dinero para un usuario.
 
     Args:
-        msg: Mensaje de Telegram con la información del usuario.
+        msg: Mensaje de Telegram con la moneda elegida.
         monto (float): Monto a ingresar.
 
-    Guarda la transacción en la base de datos y actualiza el saldo.
+    Guarda la transacción y actualiza el saldo de la billetera de esa moneda.
     """
-    monedas = ("CUP", "USD", "MLC")
-
-    # Limpiar emoji y espacios
-    texto = msg.text.strip()
-    # Extraer solo letras mayúsculas (eliminando emojis y espacios)
-    moneda_limpia = ''.join(c for c in texto if c.isalpha()).upper()
-
-    if moneda_limpia not in monedas:
-        bot.send_message(msg.chat.id, "❌ Moneda invalida!")
+    moneda = leer_moneda(msg)
+    if moneda is None:
         return
 
-    global moneda
-    moneda = moneda_limpia
+    _, saldo_actual = db.apply_movement(datos_usuario(msg), moneda, "ingreso", deposited=monto)
 
-    user_id = msg.from_user.id
-    last_id = db.get_last_id(user_id)
-    saldo_anterior = db.get_current_balance(last_id) if last_id is not None else 0.0
-    saldo_anterior_type = db.get_coin_type(last_id, "type") if last_id is not None else "CUP"
+    bot.send_message(msg.chat.id, f"✅ Ingreso realizado!\nSaldo actual: {saldo_actual} {moneda}", reply_markup=ReplyKeyboardRemove())
 
-    if moneda_limpia != saldo_anterior_type:
-        bot.send_message(
-            msg.chat.id,
-            f"⚠️ El tipo de moneda no coincide con el tipo de moneda por defecto ({saldo_anterior_type}).\nPuede convertir la moneda deseada con /convertir",
-            reply_markup=ReplyKeyboardRemove()
-        )
-        return
-
-    saldo_actual = saldo_anterior + monto
-
-    guardar_usuario(msg)
-    guardar_transaccion(msg, "ingreso", saldo_actual, monto, 0.0, saldo_anterior, saldo_anterior_type)
-
-    bot.send_message(msg.chat.id, f"✅ Ingreso realizado!\nSaldo actual: {saldo_actual} {saldo_anterior_type}")
-
-def procesar_extraccion(msg):
+def procesar_extraccion(msg, monto):
     """
     Procesa la extracción de dinero para un usuario.
 
     Args:
-        msg: Mensaje de Telegram con la información del usuario.
+        msg: Mensaje de Telegram con la moneda elegida.
+        monto (float): Monto a extraer.
 
-    Guarda la transacción en la base de datos y actualiza el saldo.
+    Guarda la transacción y actualiza el saldo de la billetera de esa moneda.
     """
-    try:
-        monto = float(msg.text.replace(",", "."))
-        if monto <= 0:
-            raise ValueError
-    except ValueError:
-        bot.send_message(msg.chat.id, "⚠️ Por favor, ingresa un monto valido y positivo.")
+    moneda = leer_moneda(msg)
+    if moneda is None:
         return
 
-    user_id = msg.from_user.id
-    last_id = db.get_last_id(user_id)
-    saldo_anterior = db.get_current_balance(last_id) if last_id is not None else 0.0
-    saldo_anterior_type = db.get_coin_type(last_id, "type") if last_id is not None else msg.text.upper()
-
+    resultado = db.apply_movement(datos_usuario(msg), moneda, "extraccion", extracted=monto)
 
-    if monto > saldo_anterior:
-        bot.send_message(msg.chat.id, f"❌ No puedes extraer mas de tu saldo actual ({saldo_anterior} {saldo_anterior_type}).")
+    if resultado is None:
+        saldo = db.get_wallet_balance(msg.from_user.id, moneda)
+        bot.send_message(msg.chat.id, f"❌ No puedes extraer mas de tu saldo actual ({saldo} {moneda}).", reply_markup=ReplyKeyboardRemove())
         return
 
-    saldo_actual = saldo_anterior - monto
+    _, saldo_actual = resultado
+    bot.send_message(msg.chat.id, f"💸 Extraccion realizada!\nSaldo actual: {saldo_actual} {moneda}", reply_markup=ReplyKeyboardRemove())
 
-    guardar_usuario(msg)
-    guardar_transaccion(msg, "extraccion", saldo_actual, 0.0, monto, saldo_anterior, saldo_anterior_type)
-    
-    bot.send_message(msg.chat.id, f"💸 Extraccion realizada!\nSaldo actual: {saldo_actual} {saldo_anterior_type}")
+def pedir_monto_conversion(msg):
+    """Solicita el monto a convertir una vez elegida la billetera de origen."""
+    moneda = leer_moneda(msg, ("USD", "MLC"))
+    if moneda is None:
+        return
+
+    bot.send_message(msg.chat.id, f"Cuanto deseas convertir de {moneda} a CUP?", reply_markup=ReplyKeyboardRemove())
+    bot.register_next_step_handler(msg, procesar_conversion, moneda)
     
-def procesar_conversion(msg, saldo_anterior, moneda, valor):
+def procesar_conversion(msg, moneda):
     """
     Procesa la conversion de dinero para un usuario.
 
     Args:
-        msg: Mensaje de Telegram con la información del usuario.
-        saldo_anterior: Saldo anterior del usuario.
-        moneda: Tipo de moneda a convertir (CUP, USD, MLC).
-        valor: Monto a convertir.
+        msg: Mensaje de Telegram con el monto a convertir.
+        moneda: Billetera de origen (USD o MLC).
 
-    Guarda la transacción en la base de datos y actualiza el saldo.
+    Descuenta el monto de la billetera de origen y lo acredita en CUP.
     """         
-    if moneda == "USD":
-        monto_convertido = valor * tasa_usd
-    else:
-        monto_convertido = valor * tasa_mlc
+    valor = leer_monto(msg)
+    if valor is None:
+        return
 
-    saldo_actual = saldo_anterior + monto_convertido
+    tasa = tasa_usd if moneda == "USD" else tasa_mlc
 
-    guardar_usuario(msg)
-    guardar_transaccion(msg, "ingreso", saldo_actual, 0.0, 0.0, saldo_anterior, "CUP")
-        
-    bot.send_message(msg.chat.id,f"✅ Conversión realizada: {valor} {moneda} = {monto_convertido} CUP\nSaldo actual: {saldo_actual} CUP", reply_markup = ReplyKeyboardRemove())
-        
-    moneda = None
-    valor = None
+    resultado = db.convert(datos_usuario(msg), moneda, valor, tasa)
+
+    if resultado is None:
+        saldo = db.get_wallet_balance(msg.from_user.id, moneda)
+        bot.send_message(msg.chat.id, f"❌ No puedes convertir mas de tu saldo actual ({saldo} {moneda}).")
+        return
+
+    (_, saldo_origen), (_, saldo_actual) = resultado
+    bot.send_message(
+        msg.chat.id,
+        f"✅ Conversión realizada: {valor} {moneda} = {valor * tasa} CUP\n"
+        f"Saldo actual: {saldo_actual} CUP | {saldo_origen} {moneda}"
+    )
         
     
 #handlers
@@ -202,16 +195,14 @@ def cmd_start(msg):
 def cmd_balance(msg):
     """
     Handler para el comando /balance.
-    Muestra el monto total.
+    Muestra el saldo de cada billetera.
     """
     logger.info("/balance")
 
-    query = db.tramites.select().where(db.tramites.c.user_id == msg.from_user.id).order_by(db.tramites.c.id.desc()).limit(1)
-    result = db.session.execute(query).fetchone()
-    if result:
-        saldo_actual = result.current_balance
-        saldo_anterior_type = result.type
-        bot.send_message(msg.chat.id, f"💰 Tu saldo actual es: {saldo_actual} {saldo_anterior_type}")
+    wallets = db.get_wallets(msg.from_user.id)
+    if wallets:
+        saldos = "\n".join(f"• {w.balance} {w.currency}" for w in wallets)
+        bot.send_message(msg.chat.id, f"💰 Tu saldo actual es:\n{saldos}")
     else:
         bot.send_message(msg.chat.id, "⚠️ No hay saldo registrado aun.")
 
@@ -231,7 +222,7 @@ def cmd_ingresar(msg):
     )
     
     bot.send_message(msg.chat.id, "Cuanto deseas ingresar? Elige una opción o escribe un monto:", reply_markup=markup)
-    bot.register_next_step_handler(msg, pedir_moneda)
+    bot.register_next_step_handler(msg, pedir_moneda, procesar_ingreso)
     
 @bot.message_handler(commands=["extraer"])
 def cmd_extraer(msg):
@@ -242,18 +233,24 @@ def cmd_extraer(msg):
     logger.info("/extraer")
     
     bot.send_message(msg.chat.id, "Cuanto deseas extraer?")
-    bot.register_next_step_handler(msg, procesar_extraccion)
+    bot.register_next_step_handler(msg, pedir_moneda, procesar_extraccion)
 
 @bot.message_handler(commands=["historial"])
 def cmd_historial(msg):
     """
     Handler para el comando /historial.
     Permite visualizar todas las transacciones realizadas hasta el momento.
+    Acepta una billetera opcional: /historial USD
     """
     logger.info("/historial")
     
-    query = db.tramites.select().where(db.tramites.c.user_id == msg.from_user.id).order_by(db.tramites.c.date.desc())
-    result = db.session.execute(query).fetchall()
+    try:
+        moneda = leer_filtro_moneda(msg)
+    except ValueError:
+        bot.send_message(msg.chat.id, "❌ Moneda invalida! Usa /historial [CUP|USD|MLC]")
+        return
+
+    result = db.get_tramites(msg.from_user.id, moneda, descending=True)
 
     if not result:
         bot.send_message(msg.chat.id, "No hay transacciones registradas aun.")
@@ -263,9 +260,9 @@ def cmd_historial(msg):
     for row in result:
         fecha = row.date.strftime("%Y-%m-%d %H:%M:%S")
         if row.operation == "ingreso":
-            linea = f"➕Ingreso: +{row.money_deposited} | Saldo: {row.current_balance} | {fecha}"
+            linea = f"➕Ingreso: +{row.money_deposited} | Saldo: {row.current_balance} {row.type} | {fecha}"
         else:
-            linea = f"➖Extraccion: -{row.money_extracted} | Saldo: {row.current_balance} | {fecha}"
+            linea = f"➖Extraccion: -{row.money_extracted} | Saldo: {row.current_balance} {row.type} | {fecha}"
         historial.append(linea)
 
     bloque = ""
@@ -279,60 +276,60 @@ def cmd_historial(msg):
 def cmd_convertir(msg):
     """
     Handler para el comando /convertir.
-    Permite convertir la moneda a CUP en caso de no ser este.
+    Permite convertir saldo de la billetera USD o MLC a la billetera CUP.
     """
     logger.info("/convertir")
     
-    if valor == None or moneda == None:
-        bot.send_message(msg.chat.id, "Opcion /convertir no disponible")
-        return
-    
-    user_id = msg.from_user.id
-    last_id = db.get_last_id(user_id)
-    if last_id is None:
-        saldo_anterior = 0.0
-    else:
-        saldo_anterior = db.get_current_balance(last_id)
+    markup = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=True)
+    markup.add(KeyboardButton("💲USD"), KeyboardButton("💲MLC"))
 
-    procesar_conversion(msg, saldo_anterior, moneda, valor)
+    bot.send_message(msg.chat.id, "Que billetera deseas convertir a CUP?", reply_markup=markup)
+    bot.register_next_step_handler(msg, pedir_monto_conversion)
     
 @bot.message_handler(commands=["grafica"])
 def cmd_grafica(msg):
     """
     Handler para el comando /grafica.
-    Envía una gráfica de la evolución del saldo del usuario.
+    Envía una gráfica de la evolución del saldo del usuario, una línea por billetera.
+    Acepta una billetera opcional: /grafica USD
     """
     logger.info("/grafica")
 
+    try:
+        moneda = leer_filtro_moneda(msg)
+    except ValueError:
+        bot.send_message(msg.chat.id, "❌ Moneda invalida! Usa /grafica [CUP|USD|MLC]")
+        return
+
     #Obtener historial de transacciones
-    query = db.tramites.select().where(
-        db.tramites.c.user_id == msg.from_user.id
-    ).order_by(db.tramites.c.date.asc())
-    result = db.session.execute(query).fetchall()
+    result = db.get_tramites(msg.from_user.id, moneda)
 
     if not result or len(result) < 2:
         bot.send_message(msg.chat.id, "📉 No hay suficientes transacciones para mostrar la gráfica.")
         return
 
-    fechas = [row.date.strftime("%Y-%m-%d %H:%M:%S") for row in result]
-    saldos = [float(row.current_balance) for row in result]
+    #Agrupar por billetera; los saldos de monedas distintas no se mezclan
+    series = {}
+    for row in result:
+        fechas, saldos = series.setdefault(row.type, ([], []))
+        fechas.append(row.date)
+        saldos.append(float(row.current_balance))
 
     plt.figure(figsize=(10, 5))
-    plt.plot(fechas, saldos, marker='o', color='blue')
-    plt.title("Evolución del saldo")
+    for tipo, (fechas, saldos) in series.items():
+        plt.plot(fechas, saldos, marker='o', label=tipo)
+
+        #Agregar valores sobre los puntos
+        for x, y in zip(fechas, saldos):
+            plt.text(x, y, f"{y:.2f}", fontsize=8, ha='center', va='bottom')
+
+    plt.title(f"Evolución del saldo ({moneda})" if moneda else "Evolución del saldo")
     plt.xlabel("Fecha")
     plt.ylabel("Saldo")
     plt.grid(True, linestyle='--', alpha=0.5)
     plt.xticks(rotation=45)
-
-    #Mostrar solo algunas fechas si hay muchas
-    if len(fechas) > 10:
-        step = max(1, len(fechas) // 10)
-        plt.xticks([fechas[i] for i in range(0, len(fechas), step)])
-
-    #Agregar valores sobre los puntos
-    for x, y in zip(fechas, saldos):
-        plt.text(x, y, f"{y:.2f}", fontsize=8, ha='center', va='bottom')
+    if len(series) > 1:
+        plt.legend()
 
     plt.tight_layout()
 
@@ -349,12 +346,18 @@ def cmd_exportar(msg):
     """
     Handler para el comando /exportar.
     Envía el historial de transacciones del usuario como archivo CSV.
+    Acepta una billetera opcional: /exportar USD
     """
     logger.info("/exportar")
 
+    try:
+        moneda = leer_filtro_moneda(msg)
+    except ValueError:
+        bot.send_message(msg.chat.id, "❌ Moneda invalida! Usa /exportar [CUP|USD|MLC]")
+        return
+
     # Obtener historial de transacciones
-    query = db.tramites.select().where(db.tramites.c.user_id == msg.from_user.id).order_by(db.tramites.c.date.asc())
-    result = db.session.execute(query).fetchall()
+    result = db.get_tramites(msg.from_user.id, moneda)
 
     if not result:
         bot.send_message(msg.chat.id, "📭 No hay transacciones para exportar.")
@@ -387,17 +390,63 @@ def cmd_exportar(msg):
 def cmd_help(msg):
     bot.send_message(msg.chat.id,
         "ℹ️ Comandos disponibles:\n"
-        "/balance - Ver tu saldo actual\n"
+        "/balance - Ver el saldo de tus billeteras\n"
         "/ingresar - Ingresar dinero\n"
         "/extraer - Extraer dinero\n"
-        "/historial - Ver historial\n"
-        "/convertir - Convertir moneda\n"
-        "/grafica - Ver gráfica de tu saldo\n"
-        "/exportar - Exportar historial a CSV\n"
+        "/historial [moneda] - Ver historial\n"
+        "/convertir - Convertir USD o MLC a CUP\n"
+        "/grafica [moneda] - Ver gráfica de tu saldo\n"
+        "/exportar [moneda] - Exportar historial a CSV\n"
         "/start - Menú principal"
     )    
 
 
+@bot.message_handler(commands=["perfil"], func=lambda msg: msg.from_user.id in ADMIN_IDS)
+def cmd_perfil(msg):
+    """
+    Handler para el comando /perfil (solo administradores).
+    Perfila los hilos del bot durante N segundos: /perfil [segundos] [umbral_ms].
+    Si se indica umbral_ms solo se capturan los updates que tarden al menos ese tiempo.
+    /perfil stop termina la sesión en curso.
+    """
+    logger.info("/perfil")
+
+    args = msg.text.split()[1:]
+    if args and args[0].lower() == "stop":
+        if not profiler.stop():
+            bot.send_message(msg.chat.id, "⚠️ No hay ningun perfil en curso.")
+        return
+
+    try:
+        segundos = float(args[0]) if args else PROFILE_SECONDS
+        umbral = float(args[1]) if len(args) > 1 else None
+        if umbral is not None and (not math.isfinite(umbral) or umbral < 0):
+            raise ValueError
+        maximo = PROFILE_MAX_SLOW_SECONDS if umbral is not None else PROFILE_MAX_SECONDS
+        # float() acepta inf y nan; un perfil sin fin bloquearia /perfil hasta reiniciar
+        if not math.isfinite(segundos) or not 0 < segundos <= maximo:
+            raise ValueError
+    except ValueError:
+        bot.send_message(
+            msg.chat.id,
+            f"⚠️ Uso: /perfil [segundos] [umbral_ms] | /perfil stop\n"
+            f"Maximo {PROFILE_MAX_SECONDS:g}s, o {PROFILE_MAX_SLOW_SECONDS:g}s con umbral."
+        )
+        return
+
+    def enviar_resumen(folded, resumen_path, resumen):
+        if folded is None:
+            bot.send_message(msg.chat.id, f"❌ {resumen}")
+            return
+        bot.send_message(msg.chat.id, f"🔥 Perfil guardado en {folded}\n\n{resumen[:3500]}")
+
+    if not profiler.start(segundos, umbral, on_done=enviar_resumen):
+        bot.send_message(msg.chat.id, "⚠️ Ya hay un perfil en curso. Usa /perfil stop para terminarlo.")
+        return
+
+    bot.send_message(msg.chat.id, f"⏱️ Perfilando durante {segundos:g}s...")
+
+
 #para comandos no validos
 @bot.message_handler(func = lambda msg: True)
 def mensaje_no_valido(msg):
@@ -414,6 +463,10 @@ def mensaje_no_valido(msg):
     
 
 if __name__ == "__main__":
+    # kill -USR1 <pid> inicia un perfil local sin pasar por Telegram
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start(PROFILE_SECONDS))
+
     logger.info("Bot Online!")
     bot.polling()
     
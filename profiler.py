@@ -0,0 +1,217 @@
+"""
+Profiler por muestreo que se puede activar en caliente sobre el bot.
+Recoge pilas de los hilos que están procesando updates y genera un archivo
+de pilas colapsadas (compatible con flamegraph.pl / speedscope) y un resumen
+con las funciones más costosas.
+"""
+import os, sys, time, threading
+from collections import Counter
+from datetime import datetime
+
+import conf
+from conf import logger
+
+
+class SamplingProfiler:
+    def __init__(self, output_dir: str, interval: float = 0.01, top_n: int = 20, warmup: float = 0.5):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.top_n = top_n
+        # En modo umbral solo se muestrean updates que ya llevan warmup * umbral en curso
+        self.warmup = warmup
+
+        self._lock = threading.Lock()
+        self._running = False
+        self._stop = threading.Event()
+        self._threshold = None
+        # ident del hilo -> (inicio del update, muestras del update)
+        self._activos = {}
+        self._stacks = Counter()
+        self._updates = 0
+        self._descartados = 0
+        self._labels = {}
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def start(self, seconds: float, threshold_ms: float = None, on_done=None) -> bool:
+        """
+        Inicia una sesión de muestreo en segundo plano.
+
+        Args:
+            seconds: Duración de la sesión.
+            threshold_ms: Si se indica, solo se conservan las muestras de los
+                updates que tarden al menos ese tiempo.
+            on_done: Callback opcional que recibe (ruta_folded, ruta_resumen, resumen).
+                Si no se pudo escribir el perfil las rutas son None y resumen describe el error.
+
+        Devuelve False si ya hay una sesión en curso.
+        """
+        with self._lock:
+            if self._running:
+                return False
+            self._running = True
+            self._stop.clear()
+            self._threshold = threshold_ms / 1000 if threshold_ms is not None else None
+            self._activos = {}
+            self._stacks = Counter()
+            self._updates = 0
+            self._descartados = 0
+
+        logger.info(f"Profiler iniciado: {seconds}s, umbral={threshold_ms}ms")
+        hilo = threading.Thread(
+            target=self._run, args=(seconds, on_done), name="SamplingProfiler", daemon=True
+        )
+        hilo.start()
+        return True
+
+    def stop(self) -> bool:
+        """Termina la sesión en curso antes de tiempo. Devuelve False si no había ninguna."""
+        with self._lock:
+            if not self._running:
+                return False
+            self._stop.set()
+        return True
+
+    def track(self, task):
+        """Envuelve la tarea de un update para que sus muestras queden asociadas a ella."""
+        def wrapper(*args, **kwargs):
+            ident = threading.get_ident()
+            inicio = time.monotonic()
+            with self._lock:
+                # Se comprueba bajo el lock para no registrarse tras el cierre de _run
+                activo = self._running
+                if activo:
+                    self._activos[ident] = (inicio, Counter())
+            if not activo:
+                return task(*args, **kwargs)
+            try:
+                return task(*args, **kwargs)
+            finally:
+                with self._lock:
+                    entrada = self._activos.pop(ident, None)
+                    if entrada is not None:
+                        self._cerrar_update(time.monotonic() - inicio, entrada[1])
+        return wrapper
+
+    def _cerrar_update(self, duracion, muestras):
+        # Debe llamarse con self._lock adquirido
+        if self._threshold is None or duracion >= self._threshold:
+            self._stacks.update(muestras)
+            self._updates += 1
+        else:
+            self._descartados += 1
+
+    def _run(self, seconds, on_done):
+        propio = threading.get_ident()
+        fin = time.monotonic() + seconds
+        desde = self._threshold * self.warmup if self._threshold is not None else 0.0
+        try:
+            while time.monotonic() < fin:
+                ahora = time.monotonic()
+                with self._lock:
+                    # Los updates aun lejos del umbral no se recorren: casi todos terminan rapido
+                    activos = [
+                        (ident, muestras)
+                        for ident, (inicio, muestras) in self._activos.items()
+                        if ahora - inicio >= desde
+                    ]
+                if activos:
+                    frames = sys._current_frames()
+                    pilas = [
+                        (muestras, self._pila(frames[ident]))
+                        for ident, muestras in activos
+                        if ident in frames and ident != propio
+                    ]
+                    del frames
+                    with self._lock:
+                        for muestras, pila in pilas:
+                            muestras[pila] += 1
+                if self._stop.wait(self.interval):
+                    break
+        finally:
+            ahora = time.monotonic()
+            with self._lock:
+                self._running = False
+                # Los updates que siguen en curso se evalúan con lo que llevan hasta ahora
+                for inicio, muestras in self._activos.values():
+                    self._cerrar_update(ahora - inicio, muestras)
+                self._activos = {}
+                stacks = self._stacks
+                # _escribir recorre stacks sin el lock; nadie debe seguir modificandolo
+                self._stacks = Counter()
+                updates, descartados = self._updates, self._descartados
+
+        try:
+            folded, resumen_path, resumen = self._escribir(stacks, updates, descartados)
+        except OSError as e:
+            logger.error(f"No se pudo escribir el perfil: {e}")
+            folded, resumen_path, resumen = None, None, f"No se pudo escribir el perfil: {e}"
+        else:
+            logger.info(f"Profiler terminado: {folded}")
+
+        if on_done:
+            try:
+                on_done(folded, resumen_path, resumen)
+            except Exception as e:
+                logger.error(f"Error al notificar el perfil: {e}")
+
+    def _pila(self, frame):
+        """Devuelve la pila de la raíz a la hoja como tupla de etiquetas."""
+        pila = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                # ';' es el separador del formato colapsado
+                nombre = code.co_name.replace(";", ":")
+                label = f"{nombre} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                self._labels[code] = label
+            pila.append(label)
+            frame = frame.f_back
+        pila.reverse()
+        return tuple(pila)
+
+    def _resumen(self, stacks, updates, descartados):
+        total = sum(stacks.values())
+        propio = Counter()
+        inclusivo = Counter()
+        for pila, n in stacks.items():
+            propio[pila[-1]] += n
+            for label in set(pila):
+                inclusivo[label] += n
+
+        lineas = [
+            f"Muestras: {total} | Updates capturados: {updates} | Descartados: {descartados}",
+            "",
+            f"Top {self.top_n} (tiempo propio):",
+        ]
+        for label, n in propio.most_common(self.top_n):
+            lineas.append(f"{n / total:7.2%} {n:6d}  {label}")
+        lineas += ["", f"Top {self.top_n} (tiempo acumulado):"]
+        for label, n in inclusivo.most_common(self.top_n):
+            lineas.append(f"{n / total:7.2%} {n:6d}  {label}")
+        return "\n".join(lineas)
+
+    def _escribir(self, stacks, updates, descartados):
+        os.makedirs(self.output_dir, exist_ok=True)
+        nombre = datetime.now().strftime("perfil_%Y%m%d_%H%M%S")
+        folded = os.path.join(self.output_dir, f"{nombre}.folded")
+        resumen_path = os.path.join(self.output_dir, f"{nombre}.txt")
+
+        with open(folded, "w", encoding="utf-8") as f:
+            for pila, n in stacks.most_common():
+                f.write(f"{';'.join(pila)} {n}\n")
+
+        if stacks:
+            resumen = self._resumen(stacks, updates, descartados)
+        else:
+            resumen = f"Sin muestras. Updates capturados: {updates} | Descartados: {descartados}"
+        with open(resumen_path, "w", encoding="utf-8") as f:
+            f.write(resumen + "\n")
+
+        return folded, resumen_path, resumen
+
+
+profiler = SamplingProfiler(conf.PROFILE_DIR, conf.PROFILE_INTERVAL)